@@ -1,36 +1,349 @@
+import argparse
+import functools
+import hashlib
+import io
 import json
+import operator
+import os
+import random
+import re
+import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+# Path of the gh executable, resolved once rather than searched for on PATH by every call.
+_GH = shutil.which("gh") or "gh"
+
+# Upper bound on repos processed at once, to stay clear of GitHub's secondary rate limits.
+MAX_WORKERS = 20
+
+# Upper bound on per-item calls, such as removing a team or a secret, made at once for a single repo step.
+ITEM_WORKERS = 4
+
+# Upper bound on gh processes running at once across all threads, as repo, step and item pools nest.
+MAX_CONCURRENT_CALLS = 20
+
+# Attempts made for a gh call failing with a server error or rate limit, and the cap in seconds on the backoff between them.
+RETRY_ATTEMPTS = 5
+RETRY_MAX_DELAY = 30
+
+# Matches gh errors worth retrying: server errors and rate limits, as opposed to failures that would recur.
+_RETRYABLE_ERROR = re.compile(r"HTTP (?:429|5\d\d)|rate limit", re.IGNORECASE)
+
+# Matches gh errors for rate limits, and the minimum wait in seconds GitHub asks for when it gives no Retry-After.
+_RATE_LIMIT_ERROR = re.compile(r"HTTP 429|rate limit", re.IGNORECASE)
+RATE_LIMIT_DELAY = 60
+
+# Holds the last response of read-only API calls, keyed by path, so they can be revalidated with their ETag.
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "repo-manager")
+
+# Records a hash of each repo's config as last applied, so unchanged repos are only synced on the next run.
+STATE_FILE = os.path.join(CACHE_DIR, "state.json")
+
+# How long an applied config is trusted before the repo is checked again, to catch changes made outside this tool.
+STATE_MAX_AGE = 24 * 60 * 60
+
+# Maps REST team permission names to their GraphQL RepositoryPermission equivalents.
+GRAPHQL_PERMISSIONS = {
+    "pull": "READ",
+    "triage": "TRIAGE",
+    "push": "WRITE",
+    "maintain": "MAINTAIN",
+    "admin": "ADMIN",
+}
+
+def _split_response(output):
+    """Splits `gh api --include` output into the status code, lower-cased headers and body."""
+    parts = re.split(r"\r?\n\r?\n", output, maxsplit=1)
+    lines = parts[0].splitlines()
+    body = parts[1] if len(parts) > 1 else ""
+    status = int(lines[0].split()[1]) if lines else None
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, headers, body
+
+# Fields every repo must end up with, after falling back to common, and the type each must have.
+REPO_FIELDS = {
+    "name": str,
+    "fork_url": str,
+    "org": str,
+    "secrets": dict,
+    "variables": dict,
+    "permissions": dict,
+}
+
+# Unpacks the fields of an effective config into Repo attributes in one call.
+_REPO_FIELD_GETTER = operator.itemgetter("name", "fork_url", "secrets", "variables", "permissions", "org")
+
+# Default for dict lookups in diffs, so each side needs one .get instead of an `in` test followed by indexing.
+_MISSING = object()
+
+def _write_json(path, data):
+    """Writes data as JSON to path atomically, so concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def load_state(path):
+    """Loads the state recorded by previous runs, or an empty state if there is none."""
+    try:
+        with open(path, "r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+def load_config(path):
+    """Loads the config file and returns the effective config of every repo in it.
+
+    Each repo's config is merged over the common config once, here, and validated before any repo is processed,
+    so a mistake in one repo's config fails the run up front instead of partway through.
+    Secrets, variables and permissions must map names to strings.
+    """
+    with open(path, "r") as config_file:
+        config = json.load(config_file)
+
+    common = config.get("common", {})
+    repos = config.get("repos", [])
+    if not isinstance(common, dict) or not isinstance(repos, list):
+        raise ValueError("Config must have a common object and a repos list")
+    effective = []
+    for index, repo in enumerate(repos):
+        if not isinstance(repo, dict):
+            raise ValueError(f"Repo #{index} must be an object")
+        merged = {**common, **repo}
+        label = merged.get("name", f"#{index}")
+        for field_name, field_type in REPO_FIELDS.items():
+            field_value = merged.get(field_name)
+            if field_value is None:
+                raise ValueError(f"No value found for field {field_name} in repo {label}")
+            if not isinstance(field_value, field_type):
+                raise ValueError(f"Field {field_name} in repo {label} must be a {field_type.__name__}")
+            if field_type is dict and not all(isinstance(value, str) for value in field_value.values()):
+                raise ValueError(f"Values of field {field_name} in repo {label} must be strings")
+        effective.append(merged)
+    return effective
+
+def worker_count(requested, repo_count):
+    """Picks how many repos to process at once.
+
+    A requested count of 0 auto-tunes from the CPU count, as the work is I/O-bound on gh subprocesses.
+    Never exceeds MAX_WORKERS or the number of repos.
+    """
+    workers = requested or (os.cpu_count() or 1) + 4
+    return max(1, min(workers, MAX_WORKERS, repo_count))
+
 class Environment(Enum):
     SECRET = "secret"
     VARIABLE = "variable"
 
+class GitHub:
+    """Wrapper around the GH CLI, shared by all repositories managed in a run.
+
+    Holds process-wide state, such as the response cache, so it is set up once rather than per repository.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._slots = threading.BoundedSemaphore(MAX_CONCURRENT_CALLS)
+        self._env = self._auth_env()
+
+    @staticmethod
+    def _auth_env():
+        """Returns the environment for gh processes, with the auth token resolved once for the whole run.
+
+        gh otherwise re-reads its hosts config and may query the keyring on every call; with GH_TOKEN set it uses
+        the token directly. Returns None, inheriting the environment as is, if a token is already set in it
+        or gh cannot provide one.
+        """
+        if os.environ.get("GH_TOKEN") or os.environ.get("GITHUB_TOKEN"):
+            return None
+        result = subprocess.run([_GH, "auth", "token"], capture_output=True, text=True)
+        token = result.stdout.strip()
+        if result.returncode != 0 or not token:
+            return None
+        return {**os.environ, "GH_TOKEN": token}
+
+    def run(self, *args, input=None, output=True):
+        """Runs a GH CLI command and returns the completed process with its stderr captured.
+
+        Stdout is captured too unless output is False, in which case it is discarded rather than buffered;
+        gh reports API errors on stderr, so callers that only check for success lose nothing.
+        Waits for a free slot first, so no more than MAX_CONCURRENT_CALLS gh processes run at once.
+        Server errors and rate limits are retried up to RETRY_ATTEMPTS times; see _retry_delay for the wait.
+        """
+        stdout = subprocess.PIPE if output else subprocess.DEVNULL
+        for attempt in range(RETRY_ATTEMPTS):
+            with self._slots:
+                result = subprocess.run([_GH, *args], input=input, stdout=stdout, stderr=subprocess.PIPE, text=True, env=self._env)
+            if result.returncode == 0 or attempt == RETRY_ATTEMPTS - 1 or not _RETRYABLE_ERROR.search(result.stderr):
+                return result
+            time.sleep(self._retry_delay(attempt, result))
+
+    @staticmethod
+    def _retry_delay(attempt, result):
+        """Returns how long to wait before retrying a failed gh call.
+
+        Honours Retry-After, or waits for X-RateLimit-Reset once the rate limit is used up, when the call
+        included response headers, which only the `--include` reads do. Other rate-limited calls, such as writes
+        run with their output discarded, wait at least RATE_LIMIT_DELAY. Anything else backs off exponentially
+        with jitter, capped at RETRY_MAX_DELAY.
+        """
+        if result.stdout and result.stdout.startswith("HTTP/"):
+            _, headers, _ = _split_response(result.stdout)
+            if headers.get("retry-after", "").isdigit():
+                return int(headers["retry-after"])
+            if headers.get("x-ratelimit-remaining") == "0" and headers.get("x-ratelimit-reset", "").isdigit():
+                return max(0, int(headers["x-ratelimit-reset"]) - time.time()) + 1
+        if _RATE_LIMIT_ERROR.search(result.stderr):
+            return RATE_LIMIT_DELAY + random.random()
+        return min(RETRY_MAX_DELAY, 2 ** attempt + random.random())
+
+    def get(self, path):
+        """Gets a single-page, read-only API path; use pages for listings.
+
+        Returns the parsed body, or None if the resource does not exist.
+        The body is shared with the in-memory cache, so callers must not modify it.
+        """
+        return next(self.pages(path))
+
+    def pages(self, path):
+        """Yields the parsed body of each page of a read-only API path, following the Link header.
+
+        Listings are consumed page by page, so no concatenated list is ever built.
+        Yields a single None if the resource does not exist.
+        """
+        next_page = path
+        while next_page is not None:
+            page, next_page = self._get_page(next_page)
+            yield page
+
+    def _cached_entry(self, path):
+        """Returns the cached response for a path, or None.
+
+        Entries are read from disk once per run and then kept in memory, so repeated requests for a path
+        within the run revalidate against the latest ETag without touching the disk.
+        """
+        if path not in self._entries:
+            try:
+                with open(self._cache_file(path), "r") as f:
+                    self._entries[path] = json.load(f)
+            except (OSError, ValueError):
+                self._entries[path] = None
+        return self._entries[path]
+
+    def _cache_file(self, path):
+        """Returns the on-disk cache file for a path."""
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+    def _get_page(self, path):
+        """Gets a single page, revalidating the cached copy from a previous request.
+
+        Sends the cached ETag as If-None-Match; a 304 reuses the cached body and does not count against the rate limit.
+        Returns the parsed body, or None if the resource does not exist, and the URL of the next page if any.
+        """
+        cached = self._cached_entry(path)
+
+        headers = ["-H", f"If-None-Match: {cached['etag']}"] if cached else []
+        result = self.run("api", "--include", *headers, path)
+        status, response_headers, body = _split_response(result.stdout)
+
+        if status == 304 and cached:
+            return cached["body"], cached.get("next")
+        if status == 404:
+            return None, None
+        if result.returncode != 0 or status != 200:
+            raise ValueError(f"Failed to get {path} (exit code {result.returncode}): {result.stderr.strip()}")
+
+        data = json.loads(body)
+        next_link = re.search(r'<([^>]+)>;\s*rel="next"', response_headers.get("link", ""))
+        next_page = next_link.group(1) if next_link else None
+        if "etag" in response_headers:
+            self._entries[path] = {"etag": response_headers["etag"], "next": next_page, "body": data, "fetched_at": time.time()}
+            _write_json(self._cache_file(path), self._entries[path])
+        return data, next_page
+
+    def graphql(self, query, variables):
+        """Runs a GraphQL request and returns the response data.
+
+        The request body is passed on stdin so variables keep their JSON types.
+        """
+        result = self.run("api", "graphql", "--input", "-", input=json.dumps({"query": query, "variables": variables}))
+        if result.returncode != 0:
+            raise ValueError(f"GraphQL request failed (exit code {result.returncode}): {result.stderr.strip()}")
+        return json.loads(result.stdout)["data"]
+
 class Repo:
     """Class representing a repository to be managed."""
 
-    def __init__(self, repo, common):
+    # Constant leading arguments of the gh api write calls; only the endpoint and fields vary per call.
+    _GH_API_PUT = ("api", "-X", "PUT")
+    _GH_API_DELETE = ("api", "-X", "DELETE")
+
+    def __init__(self, config, github):
         """Initializes a Repo instance with configuration data.
 
-        Reads fields from the repo config, falling back to common config if not present.
+        Takes the repo's effective config, already merged over the common config by load_config.
+        All GH CLI calls go through the given GitHub instance, which is shared between repos.
         """
-        self._common = common
-        self._repo = repo
-        self.name = self._get_field("name")
-        self.fork_url = self._get_field("fork_url")
-        self.secrets = self._get_field("secrets")
-        self.variables = self._get_field("variables")
-        self.permissions = self._get_field("permissions")
-        self.org = self._get_field("org")
-
-    def _get_field(self, field_name):
-        """Gets a non-list field from a repo config, or from common if not found in repo config."""
-        field_value = self._repo.get(field_name, self._common.get(field_name, None))
-        if field_value is None:
-            raise ValueError(f"No value found for field {field_name}")
-        return field_value
-    
+        self._github = github
+        self._config = config
+        self._state = None
+        try:
+            (self.name, self.fork_url, self.secrets, self.variables, self.permissions, self.org) = _REPO_FIELD_GETTER(config)
+        except KeyError as e:
+            raise ValueError(f"No value found for field {e.args[0]}") from None
+        self._output = io.StringIO()
+
+    def _print(self, *args, **kwargs):
+        """Prints to the repo's output buffer so output from concurrently processed repos does not interleave."""
+        print(*args, file=self._output, **kwargs)
+
+    def _print_report(self, title, categories):
+        """Prints a change report under a title, listing each non-empty category of lines.
+
+        The report is written in one call, as the update steps producing reports run concurrently.
+        """
+        report = [title]
+        for category, lines in categories:
+            if lines:
+                report.append(f"  {category}:")
+                report.extend(lines)
+        self._output.write("\n".join(report) + "\n")
+
+    def _flush_output(self):
+        """Writes the buffered output to stdout in one go and clears the buffer."""
+        sys.stdout.write(self._output.getvalue())
+        sys.stdout.flush()
+        self._output = io.StringIO()
+
+    def fetch_environment(self, environment: Environment):
+        """Fetches the repository's existing secrets or variables as a name to value dict.
+
+        Secret values are not retrievable from GitHub, so every secret maps to "***".
+        Uses conditional requests, so unchanged listings are answered with a 304 from the response cache.
+        """
+        existing_data = {}
+        for values in self._github.pages(f"repos/{self.org}/{self.name}/actions/{environment.value}s?per_page=100"):
+            if values is None:
+                raise ValueError(f"Failed to get {environment.value}s for repo {self.name}, repo not found")
+            existing_data.update((value["name"], value.get("value", "***")) for value in values[f"{environment.value}s"])
+        return existing_data
+
     def update_environment(self, environment: Environment):
         """Updates secrets or variables for the repository.
 
@@ -42,90 +355,79 @@ class Repo:
         else:
             environment_data = self.variables
 
-        values_result = subprocess.run([
-            "gh", "api", f"repos/{self.org}/{self.name}/actions/{environment.value}s"
-        ], capture_output=True, text=True, check=True)
-        existing_data = {value["name"]: value.get("value", "***") for value in json.loads(values_result.stdout).get(f"{environment.value}s", [])}
+        existing_data = self.fetch_state()[environment.value]
 
-        all_data = set(existing_data.keys()).union(set(environment_data.keys()))
-        
         to_add={}
-        overwritten = ""
-        edited = ""
-        added = ""
-        removed = ""
-        unchanged = ""
-        for value_name in all_data:
-            present_in_existing = value_name in existing_data
-            present_in_config = value_name in environment_data
-            if present_in_existing and present_in_config:
-                if existing_data[value_name] == "***":
-                    overwritten += f"    {value_name}: *** => ***\n"
-                    to_add[value_name] = environment_data[value_name]
-                elif existing_data[value_name] != environment_data[value_name]:
-                    edited += f"    {value_name}: {existing_data[value_name]} => {environment_data[value_name] if environment == Environment.VARIABLE else '***'}\n"
-                    to_add[value_name] = environment_data[value_name]
+        to_remove = []
+        overwritten = []
+        edited = []
+        added = []
+        removed = []
+        unchanged = []
+        for value_name in sorted(existing_data.keys() | environment_data.keys()):
+            existing_value = existing_data.get(value_name, _MISSING)
+            config_value = environment_data.get(value_name, _MISSING)
+            shown_value = config_value if environment == Environment.VARIABLE else "***"
+            if existing_value is not _MISSING and config_value is not _MISSING:
+                if existing_value == "***":
+                    overwritten.append(f"    {value_name}: *** => ***")
+                    to_add[value_name] = config_value
+                elif existing_value != config_value:
+                    edited.append(f"    {value_name}: {existing_value} => {shown_value}")
+                    to_add[value_name] = config_value
                 else:
-                    unchanged += f"    {value_name}: {existing_data[value_name]}\n"
-            elif not present_in_existing and present_in_config:
-                added += f"    {value_name}: {environment_data[value_name] if environment == Environment.VARIABLE else '***'}\n"
-                to_add[value_name] = environment_data[value_name]
-            elif present_in_existing and not present_in_config:
-                removed += f"    {value_name}: {existing_data[value_name]}\n"
-                self.remove_environment_value(environment, value_name)
-
+                    unchanged.append(f"    {value_name}: {existing_value}")
+            elif config_value is not _MISSING:
+                added.append(f"    {value_name}: {shown_value}")
+                to_add[value_name] = config_value
+            else:
+                removed.append(f"    {value_name}: {existing_value}")
+                to_remove.append(value_name)
+
+        self._run_concurrently(
+            *(functools.partial(self.remove_environment_value, environment, value_name) for value_name in to_remove),
+            max_workers=ITEM_WORKERS
+        )
         if to_add:
             self.add_environment_values(environment, to_add)
 
-        print(f"{environment.value.capitalize()}s:")
-        if overwritten:
-            print(f"  Overwritten:\n{overwritten}", end="")
-        if edited:
-            print(f"  Edited:\n{edited}", end="")
-        if added:
-            print(f"  Added:\n{added}", end="")
-        if removed:
-            print(f"  Removed:\n{removed}", end="")
-        if unchanged:
-            print(f"  Unchanged:\n{unchanged}", end="")
+        self._print_report(
+            f"{environment.value.capitalize()}s:",
+            (("Overwritten", overwritten), ("Edited", edited), ("Added", added), ("Removed", removed), ("Unchanged", unchanged))
+        )
 
     def remove_environment_value(self, environment: Environment, value_name):
         """Removes a secret or variable from the repository.
         
         TODO: Move to use gh CLI command instead of API.
         """
-        result = subprocess.run([
-            "gh", "api", "-X", "DELETE", 
-            f"repos/{self.org}/{self.name}/actions/{environment.value}s/{value_name}"
-        ], capture_output=True, text=True)
+        result = self._github.run(
+            *self._GH_API_DELETE,
+            f"repos/{self.org}/{self.name}/actions/{environment.value}s/{value_name}",
+            output=False
+        )
         if result.returncode != 0:
-            print(f"Error deleting {environment.value}: {value_name}")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            self._print(f"Error deleting {environment.value}: {value_name}")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to delete {environment.value} {value_name} from repo {self.name}")
 
     def add_environment_values(self, environment: Environment, values):
         """Adds secrets or variables to the repository in bulk.
 
-        Writes all key-value pairs to a temporary file that is then passed to the gh CLI.
+        Passes all key-value pairs to the gh CLI as a dotenv file on stdin, so nothing is written to disk.
         """
         if not values:
             return
-        with tempfile.NamedTemporaryFile(mode='w+', delete=True) as temp_file:
-            for key, value in values.items():
-                temp_file.write(f"{key}={value}\n")
-            temp_file.flush()
-            
-            result = subprocess.run([
-                "gh", environment.value, "set", 
-                "--repo", f"{self.org}/{self.name}",
-                "-f", temp_file.name
-            ], capture_output=True, text=True)
-            
+        result = self._github.run(
+            environment.value, "set",
+            "--repo", f"{self.org}/{self.name}",
+            "-f", "-",
+            input="".join(f"{key}={value}\n" for key, value in values.items()),
+            output=False
+        )
         if result.returncode != 0:
-            print(f"Error setting {environment.value}:")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            self._print(f"Error setting {environment.value}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to set {environment.value} for repo {self.name}")
 
     def update_variables(self):
@@ -150,43 +452,119 @@ class Repo:
         
         Uses GH API through the GH CLI as there is no GH CLI command for this.
         """
-        result = subprocess.run([
-            "gh", "api", f"repos/{self.org}/{self.name}/branches/main/protection",
-            "--method", "PUT",
+        result = self._github.run(
+            *self._GH_API_PUT,
+            f"repos/{self.org}/{self.name}/branches/main/protection",
             "--field", "enforce_admins=true",
             "--field", "required_pull_request_reviews=null",
             "--field", "required_status_checks=null",
             "--field", "restrictions=null",
             "--field", "lock_branch=true",
-            "--field", "allow_fork_syncing=true"
-        ], capture_output=True, text=True)
+            "--field", "allow_fork_syncing=true",
+            output=False
+        )
         
         if result.returncode != 0:
-            print(f"Error locking main branch for repo {self.name}:")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            self._print(f"Error locking main branch for repo {self.name}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to lock main branch for repo {self.name}")
 
+    def is_main_branch_locked(self):
+        """Checks whether the main branch protection already matches what lock_main_branch sets.
+
+        The PUT replaces the whole protection, resetting the options it omits to disabled,
+        so those must be disabled too for the PUT to be skipped.
+        """
+        protection = self._github.get(f"repos/{self.org}/{self.name}/branches/main/protection")
+        if protection is None:
+            return False
+        return (
+            all(protection.get(setting, {}).get("enabled") for setting in ("enforce_admins", "lock_branch", "allow_fork_syncing"))
+            and not any(setting in protection for setting in ("required_pull_request_reviews", "required_status_checks", "restrictions"))
+            and not any(
+                protection.get(setting, {}).get("enabled")
+                for setting in (
+                    "allow_force_pushes", "allow_deletions", "required_linear_history", "block_creations",
+                    "required_conversation_resolution",
+                )
+            )
+        )
+
+    def update_main_branch_lock(self):
+        """Locks the main branch of the repository, unless its protection already matches."""
+        if self.is_main_branch_locked():
+            self._print("Main branch: already locked")
+        else:
+            self.lock_main_branch()
+            self._print("Main branch: locked")
+
     def set_permissions(self):
         """Sets team permissions for the repository."""
-        for team_slug, permission in self.permissions.items():
-            self.add_permission(team_slug, permission)
+        self.add_permissions(self.permissions)
+
+    def add_permissions(self, permissions):
+        """Adds permissions for several teams on the repository in bulk.
+
+        Looks up the repo and team node IDs in one GraphQL query, then grants all permissions in one request
+        with an aliased updateTeamsRepository mutation per permission level.
+        A single team, or a custom repository role that GraphQL cannot express, is set through REST instead.
+        """
+        batched = {team: perm for team, perm in permissions.items() if perm in GRAPHQL_PERMISSIONS}
+        if len(batched) < 2:
+            batched = {}
+        self._run_concurrently(
+            *(functools.partial(self.add_permission, team_slug, permission)
+              for team_slug, permission in permissions.items() if team_slug not in batched),
+            max_workers=ITEM_WORKERS
+        )
+        if not batched:
+            return
+
+        aliases = {f"t{index}": team for index, team in enumerate(batched)}
+        ids = self._github.graphql(
+            "query($org: String!, $name: String!, "
+            + ", ".join(f"${alias}: String!" for alias in aliases)
+            + ") { repository(owner: $org, name: $name) { id } organization(login: $org) { "
+            + " ".join(f"{alias}: team(slug: ${alias}) {{ id }}" for alias in aliases)
+            + " } }",
+            {"org": self.org, "name": self.name, **aliases},
+        )
+        if ids["repository"] is None:
+            raise ValueError(f"Repo {self.name} not found in org {self.org}")
+        team_ids = {}
+        for alias, team_slug in aliases.items():
+            team = ids["organization"][alias]
+            if team is None:
+                raise ValueError(f"Team {team_slug} not found in org {self.org}")
+            team_ids.setdefault(GRAPHQL_PERMISSIONS[batched[team_slug]], []).append(team["id"])
+
+        self._github.graphql(
+            "mutation($repo: ID!, "
+            + ", ".join(f"${permission}: [ID!]!" for permission in team_ids)
+            + ") { "
+            + " ".join(
+                f"{permission}: updateTeamsRepository(input: {{repositoryId: $repo, teamIds: ${permission}, "
+                f"permission: {permission}}}) {{ clientMutationId }}"
+                for permission in team_ids
+            )
+            + " }",
+            {"repo": ids["repository"]["id"], **team_ids},
+        )
 
     def add_permission(self, team_slug, permission):
         """Adds a permission for a team on the repository.
         
         Uses GH API through the GH CLI as there is no GH CLI command for this.
         """
-        result = subprocess.run([
-                "gh", "api", 
-                "-X", "PUT",
-                f"/orgs/{self.org}/teams/{team_slug}/repos/{self.org}/{self.name}",
-                "-f", f"permission={permission}"
-            ], capture_output=True, text=True)
+        result = self._github.run(
+            *self._GH_API_PUT,
+            f"/orgs/{self.org}/teams/{team_slug}/repos/{self.org}/{self.name}",
+            "-f", f"permission={permission}",
+            output=False
+        )
         if result.returncode != 0:
-            print(f"Error setting permission for team {team_slug}:")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            self._print(f"Error setting permission for team {team_slug}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to set permission {permission} for team {team_slug} on repo {self.name}")
     
     def remove_permission(self, team_slug):
@@ -194,15 +572,14 @@ class Repo:
         
         Uses GH API through the GH CLI as there is no GH CLI command for this.
         """
-        result = subprocess.run([
-                "gh", "api", 
-                "-X", "DELETE",
-                f"/orgs/{self.org}/teams/{team_slug}/repos/{self.org}/{self.name}"
-            ], capture_output=True, text=True)
+        result = self._github.run(
+            *self._GH_API_DELETE,
+            f"/orgs/{self.org}/teams/{team_slug}/repos/{self.org}/{self.name}",
+            output=False
+        )
         if result.returncode != 0:
-            print(f"Error removing permission for team {team_slug}:")
-            print(f"stdout: {result.stdout}")
-            print(f"stderr: {result.stderr}")
+            self._print(f"Error removing permission for team {team_slug}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to remove permissions for team {team_slug} on repo {self.name}")
 
     def update_permissions(self):
@@ -210,100 +587,169 @@ class Repo:
 
         Compares existing permissions with those in the config and adds/edits/removes as necessary.
         """
-        # Get team permissions
-        teams_result = subprocess.run([
-            "gh", "api", f"repos/{self.org}/{self.name}/teams"
-        ], capture_output=True, text=True, check=True)
-
-        existing_perms = { perm["slug"]: perm["permission"] for perm in json.loads(teams_result.stdout) }
-
-        all_teams = set(existing_perms.keys()).union(set(self.permissions.keys()))
-        edited = ""
-        added = ""
-        removed = ""
-        unchanged = ""
-        for team in all_teams:
-            present_in_existing = team in existing_perms
-            present_in_config = team in self.permissions
-            if present_in_existing and present_in_config:
-                if existing_perms[team] != self.permissions[team]:
-                    edited += f"    {team}: {existing_perms[team]} => {self.permissions[team]}\n"
-                    self.add_permission(team, self.permissions[team])
-                else:
-                    unchanged += f"    {team}: {existing_perms[team]}\n"
-            elif not present_in_existing and present_in_config:
-                added += f"    {team}: {self.permissions[team]}\n"
-                self.add_permission(team, self.permissions[team])
-            elif present_in_existing and not present_in_config:
-                removed += f"    {team}: {existing_perms[team]}\n"
-                self.remove_permission(team)
-        print("Permissions:")
-        if edited:
-            print(f"  Edited:\n{edited}", end="")
-        if added:
-            print(f"  Added:\n{added}", end="")
-        if removed:
-            print(f"  Removed:\n{removed}", end="")
-        if unchanged:
-            print(f"  Unchanged:\n{unchanged}", end="")
+        existing_perms = self.fetch_state()["permissions"]
+
+        existing_teams = existing_perms.keys()
+        config_teams = self.permissions.keys()
+        common_teams = existing_teams & config_teams
+        edited_teams = sorted(team for team in common_teams if existing_perms[team] != self.permissions[team])
+        unchanged_teams = sorted(common_teams.difference(edited_teams))
+        added_teams = sorted(config_teams - existing_teams)
+        removed_teams = sorted(existing_teams - config_teams)
+
+        self._run_concurrently(
+            *(functools.partial(self.remove_permission, team) for team in removed_teams),
+            max_workers=ITEM_WORKERS
+        )
+        to_add = {team: self.permissions[team] for team in edited_teams + added_teams}
+        if to_add:
+            self.add_permissions(to_add)
+
+        edited = [f"    {team}: {existing_perms[team]} => {self.permissions[team]}" for team in edited_teams]
+        added = [f"    {team}: {self.permissions[team]}" for team in added_teams]
+        removed = [f"    {team}: {existing_perms[team]}" for team in removed_teams]
+        unchanged = [f"    {team}: {existing_perms[team]}" for team in unchanged_teams]
+        self._print_report("Permissions:", (("Edited", edited), ("Added", added), ("Removed", removed), ("Unchanged", unchanged)))
+
+    def _run_concurrently(self, *steps, max_workers=None):
+        """Runs independent steps concurrently, re-raising the first failure once all of them have finished.
+
+        Any further failures are printed to the repo's output with their traceback, so none of them are lost.
+        Runs every step at once unless max_workers is given.
+        """
+        if not steps:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers or len(steps)) as executor:
+            futures = [executor.submit(step) for step in steps]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for error in errors[1:]:
+            self._print("".join(traceback.format_exception(type(error), error, error.__traceback__)), end="")
+        if errors:
+            raise errors[0]
 
     def create(self):
-        """Creates a new repository and configures it."""
-        print(f"Creating repo {self.name} in org {self.org}")
+        """Creates a new repository and configures it.
+
+        Permissions, variables, secrets and branch protection touch disjoint endpoints,
+        so they are set concurrently once the fork exists.
+        """
+        self._print(f"Creating repo {self.name} in org {self.org}")
         # Re-add when testing in an org
-        # if subprocess.call(["gh", "repo", "fork", self.fork_url, "--clone=false", "--org", self.org, "--default-branch-only"]) != 0:
-        if subprocess.call(["gh", "repo", "fork", self.fork_url, "--clone=false", "--default-branch-only"]) != 0:
+        # result = self._github.run("repo", "fork", self.fork_url, "--clone=false", "--org", self.org, "--default-branch-only")
+        result = self._github.run("repo", "fork", self.fork_url, "--clone=false", "--default-branch-only", output=False)
+        if result.returncode != 0:
+            self._print(f"Error forking repo {self.fork_url}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to fork repo {self.fork_url} into org {self.org}")
-        print(f"Setting permissions for repo {self.name}")
-        self.set_permissions()
-        print(f"Setting variables for repo {self.name}")
-        self.set_variables()
-        print(f"Setting secrets for repo {self.name}")
-        self.set_secrets()
-        print(f"Locking main branch for repo {self.name}")
-        self.lock_main_branch()
+        self._print(f"Setting permissions, variables, secrets and branch protection for repo {self.name}")
+        self._run_concurrently(self.set_permissions, self.set_variables, self.set_secrets, self.lock_main_branch)
 
-    def update(self):
-        """Updates an existing repository's configuration."""
-        print(f"Updating repo {self.name} in org {self.org}")
-        if subprocess.call(["gh", "repo", "sync", f"{self.org}/{self.name}"]) != 0:
+    def sync(self):
+        """Syncs the fork's default branch with its upstream repository."""
+        result = self._github.run("repo", "sync", f"{self.org}/{self.name}", output=False)
+        if result.returncode != 0:
+            self._print(f"Error syncing repo {self.name}:")
+            self._print(f"stderr: {result.stderr}")
             raise ValueError(f"Failed to sync repo {self.name} in org {self.org}")
-        print(f"Setting permissions for repo {self.name}")
-        self.update_permissions()
-        print(f"Setting variables for repo {self.name}")
-        self.update_variables()
-        print(f"Setting secrets for repo {self.name}")
-        self.update_secrets()
-        print(f"Locking main branch for repo {self.name}")
-        self.lock_main_branch()
+
+    def update(self):
+        """Updates an existing repository's configuration.
+
+        Permissions, variables, secrets and branch protection touch disjoint endpoints, so they are updated concurrently.
+        """
+        self._print(f"Updating repo {self.name} in org {self.org}")
+        self.sync()
+        self._print(f"Updating permissions, variables, secrets and branch protection for repo {self.name}")
+        self._run_concurrently(self.update_permissions, self.update_variables, self.update_secrets, self.update_main_branch_lock)
+
+    def fetch_state(self):
+        """Fetches the repository's current state: whether it exists, its team permissions, variables and secrets.
+
+        The teams endpoint returns 404 for a missing repo, so on the usual path its first request also answers whether
+        the repo exists. A 404 there is confirmed against the repo itself before the repo is treated as missing,
+        so an existing repo is never forked again.
+        Variables and secrets are fetched concurrently. The state is fetched once and cached,
+        so it reflects the repo as it was before this run's changes.
+        """
+        if self._state is not None:
+            return self._state
+
+        existing_perms = {}
+        for teams in self._github.pages(f"repos/{self.org}/{self.name}/teams?per_page=100"):
+            if teams is None:
+                if self._github.get(f"repos/{self.org}/{self.name}") is not None:
+                    raise ValueError(f"Failed to list teams for repo {self.name} in org {self.org}")
+                self._state = {"exists": False}
+                return self._state
+            existing_perms.update((perm["slug"], perm["permission"]) for perm in teams)
+
+        state = {"exists": True, "permissions": existing_perms}
+
+        def fetch(environment):
+            state[environment.value] = self.fetch_environment(environment)
+
+        self._run_concurrently(functools.partial(fetch, Environment.VARIABLE), functools.partial(fetch, Environment.SECRET))
+        self._state = state
+        return self._state
 
     def exists(self):
         """Checks if the repository exists in the organization."""
-        result = subprocess.run([
-            "gh", "api", f"repos/{self.org}/{self.name}"
-        ], capture_output=True, text=True)
+        return self.fetch_state()["exists"]
 
-        if result.returncode == 0:
-            return True
-
-        if "404" in result.stderr or "Not Found" in result.stderr:
-            return False
+    def fingerprint(self):
+        """Returns a hash of the repo's effective config, used to tell whether it changed since the last run."""
+        return hashlib.sha256(json.dumps(self._config, sort_keys=True).encode()).hexdigest()
 
-        print(f"Error checking if repo {self.org}/{self.name} exists:")
-        print(f"stdout: {result.stdout}")
-        print(f"stderr: {result.stderr}")
-        raise ValueError(f"Unable to determine if repo {self.org}/{self.name} exists due to error (exit code {result.returncode})")
+    def create_or_update(self, state=None):
+        """Creates or updates the repository based on its existence.
 
-    def create_or_update(self):
-        """Creates or updates the repository based on its existence."""
-        if self.exists():
-            self.update()
-        else:
-            self.create()
+        If state from a previous run is given, only the fork sync is run when the repo's config is unchanged and was
+        applied less than STATE_MAX_AGE ago, as upstream changes are not covered by the config fingerprint.
+        The state is updated once the repo has been processed successfully.
+        Output is buffered while working and written once at the end, even on failure.
+        """
+        key = f"{self.org}/{self.name}"
+        fingerprint = self.fingerprint()
+        previous = state.get(key) if state is not None else None
+        try:
+            if previous and previous["hash"] == fingerprint and time.time() - previous["applied_at"] < STATE_MAX_AGE:
+                self._print(f"Syncing repo {self.name} in org {self.org}, config unchanged since last run")
+                self.sync()
+                return
+            if self.exists():
+                self.update()
+            else:
+                self.create()
+        finally:
+            self._flush_output()
+        if state is not None:
+            state[key] = {"hash": fingerprint, "applied_at": time.time()}
 
 if __name__ == "__main__":
-    with open("config.json", "r") as config_file:
-        config = json.load(config_file)
-
-    for repo in config.get("repos", []):
-        Repo(repo, config["common"]).create_or_update()
+    parser = argparse.ArgumentParser(description="Creates or updates the repositories listed in config.json.")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help=f"number of repos to process at once, 0 to auto-tune (at most {MAX_WORKERS})")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="process every repo, even if its config is unchanged since the last run")
+    args = parser.parse_args()
+
+    github = GitHub()
+    repos = [Repo(config, github) for config in load_config("config.json")]
+    state = {} if args.force else load_state(STATE_FILE)
+    failed = []
+    if repos:
+        try:
+            # Repos are independent and the work is I/O-bound on gh subprocesses, so process them concurrently.
+            with ThreadPoolExecutor(max_workers=worker_count(args.workers, len(repos))) as executor:
+                futures = [executor.submit(repo.create_or_update, state) for repo in repos]
+            # Every failed repo is reported, not just the first, and the run carries on with the others.
+            for repo, future in zip(repos, futures):
+                error = future.exception()
+                if error is not None:
+                    failed.append(repo.name)
+                    print(f"Error processing repo {repo.name} in org {repo.org}:", file=sys.stderr)
+                    traceback.print_exception(type(error), error, error.__traceback__)
+        finally:
+            _write_json(STATE_FILE, state)
+    if failed:
+        sys.exit(f"Failed to process {len(failed)} repo(s): {', '.join(failed)}")